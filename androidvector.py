@@ -29,27 +29,123 @@ import simplestyle as ss
 
 inkex.localize()
 
-def _ns(tag):
-    """Add the Android namespace to a tag or attribute.
-        
+_IDENTITY = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+# str() switches to scientific notation below this magnitude
+_SMALL_NUMBER = 1e-4
+
+_ANDROID_NS = 'http://schemas.android.com/apk/res/android'
+_NSMAP = {'android': _ANDROID_NS}
+
+# svg tags and attributes
+_SVG_DEFS = inkex.addNS('defs', 'svg')
+_SVG_G = inkex.addNS('g', 'svg')
+_SVG_PATH = inkex.addNS('path', 'svg')
+_SVG_STOP = inkex.addNS('stop', 'svg')
+_XLINK_HREF = inkex.addNS('href', 'xlink')
+
+# android attribute names, with the Android namespace added
+_NS = dict((tag, '{%s}%s' % (_ANDROID_NS, tag)) for tag in (
+    'name', 'width', 'height', 'viewportWidth', 'viewportHeight',
+    'pathData', 'fillColor', 'fillAlpha', 'fillType',
+    'strokeColor', 'strokeWidth', 'strokeAlpha',
+    'strokeLineCap', 'strokeLineJoin', 'strokeMiterLimit'))
+
+# stroke styles copied as-is, as (style property, android attribute) pairs
+_STROKE_PASSTHROUGH = (
+    ('stroke-linecap', _NS['strokeLineCap']),
+    ('stroke-linejoin', _NS['strokeLineJoin']),
+    ('stroke-miterlimit', _NS['strokeMiterLimit']),
+)
+
+def _csp_points(p):
+    """Flatten a cubic superpath into a single list of points.
+    
+    Return a list of [x, y] lists.  The points are the same objects held by
+    the superpath, so modifying them modifies the path.
+    
     Required arguments:
-    tag -- string, tag or attribute
+    p -- list, cubic superpath
     """
-    return '{%s}%s' % ('http://schemas.android.com/apk/res/android', tag)
+    return [pt for subpath in p for csp_point in subpath for pt in csp_point]
+
+def _format_path(p):
+    """Format a cubic superpath as SVG path data.
+    
+    Equivalent to cubicsuperpath.formatPath, but writes the path data
+    directly instead of building an intermediate simple path.
+    
+    Required arguments:
+    p -- list, cubic superpath
+    """
+    parts = []
+    for subpath in p:
+        if not subpath:
+            continue
+        parts.append('M' + ' '.join([str(c) for c in subpath[0][1]]))
+        for i in range(1, len(subpath)):
+            coords = subpath[i - 1][2] + subpath[i][0] + subpath[i][1]
+            parts.append('C' + ' '.join([str(c) for c in coords]))
+    return ''.join(parts)
+
+def _compose_node_transform(mat, node):
+    """Compose a matrix with the transform attribute of a node.
+    
+    Return a new matrix, or mat itself if the node has no transform.
+    
+    Required arguments:
+    mat -- list, composite transform matrix of the node's parent
+    node -- Element, node whose transform to apply
+    """
+    if 'transform' not in node.attrib:
+        return mat
+    t = st.parseTransform(node.get('transform'))
+    if t == _IDENTITY:
+        return mat
+    return st.composeTransform(mat, t)
+
+def _transform_points(mat, points, eps):
+    """Transform points, and replace very small coordinates with zero (in place).
+    
+    Both steps are done in a single pass over the points.
+    
+    Required arguments:
+    mat -- list, transform matrix
+    points -- list of [x, y] lists, e.g. from _csp_points
+    eps -- float, coordinates with a smaller magnitude are set to zero
+    """
+    (a, c, e), (b, d, f) = mat
+    for pt in points:
+        x = a*pt[0] + c*pt[1] + e
+        y = b*pt[0] + d*pt[1] + f
+        pt[0] = 0.0 if -eps < x < eps else x
+        pt[1] = 0.0 if -eps < y < eps else y
 
 class AndroidVector(inkex.Effect):
     """Main effect class."""
     
+    def __init__(self):
+        inkex.Effect.__init__(self)
+        self.OptionParser.add_option('--pretty', action='store', type='inkbool',
+            dest='pretty', default=False,
+            help='Indent the output XML for readability')
+        
+        # unittouu moved from inkex to inkex.Effect in Inkscape 0.91
+        if hasattr(inkex, 'unittouu'):
+            self._unittouu = inkex.unittouu
+        else:
+            self._unittouu = self.unittouu
+    
     def effect(self):
         """Convert the SVG to an Android Vector XML object."""
+        self.etree = None
+        
         # get inkscape root element
         svg = self.document.getroot()
         
-        # initialize android root element
-        vector = et.Element('vector')
-        
         # handle root attributes
-        vector.set(_ns('name'), svg.get('id', 'svgimage'))
+        attrib = {}
+        attrib[_NS['name']] = svg.get('id', 'svgimage')
         
         width = svg.get('width')
         height = svg.get('height')
@@ -60,8 +156,8 @@ class AndroidVector(inkex.Effect):
             inkex.errormsg(_('The document height attribute is missing.'))
             return
         # width and height are the only attributes using non-user units in the vector tag
-        vector.set(_ns('width'), str(self.uutounit(self.__unittouu(width), 'px')) + 'dp')
-        vector.set(_ns('height'), str(self.uutounit(self.__unittouu(height), 'px')) + 'dp')
+        attrib[_NS['width']] = str(self.uutounit(self._unittouu(width), 'px')) + 'dp'
+        attrib[_NS['height']] = str(self.uutounit(self._unittouu(height), 'px')) + 'dp'
         
         view_box = svg.get('viewBox')
         if view_box is None:
@@ -79,175 +175,199 @@ class AndroidVector(inkex.Effect):
         # set scale (remove need for scientific notation)
         svg.set('transform', 'scale(%f %f)' % (scale_fact, scale_fact))
         
-        vector.set(_ns('viewportWidth'), str(view_width * scale_fact))
-        vector.set(_ns('viewportHeight'), str(view_height * scale_fact))
+        attrib[_NS['viewportWidth']] = str(view_width * scale_fact)
+        attrib[_NS['viewportHeight']] = str(view_height * scale_fact)
+        
+        # index definitions by id (for gradient lookups)
+        self.defs_index = {}
+        for defs in svg.iterchildren(_SVG_DEFS):
+            for el in defs:
+                el_id = el.get('id')
+                if el_id is not None and el_id not in self.defs_index:
+                    self.defs_index[el_id] = el
+        
+        # colors already parsed by _get_color
+        self.color_cache = {}
+        
+        # initialize android root element
+        vector = et.Element('vector', attrib, nsmap=_NSMAP)
         
         # parse child elements
         self.unique_id = 0
-        ancestors = [svg]
-        for el in svg:
-            tag = self._get_tag_name(el)
-            # ignore root's incompatible children
-            if tag == 'g' or tag == 'path':
-                subel = self._parse_child(el, ancestors)
-                if subel is not None:
-                    vector.append(subel)
+        mat = _compose_node_transform(_IDENTITY, svg)
+        # ignore root's incompatible children
+        for el in svg.iterchildren(_SVG_G, _SVG_PATH):
+            subel = self._parse_tree(el, mat)
+            if subel is not None:
+                vector.append(subel)
         
         # save element tree
         self.etree = et.ElementTree(vector)
     
     def output(self):
         """Write element tree to file."""
-        self.etree.write(sys.stdout, pretty_print=True)
+        if self.etree is None:
+            return
+        
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        self.etree.write(out, pretty_print=self.options.pretty,
+            xml_declaration=True, encoding='utf-8')
     
-    def __unittouu(self, param):
-        """Wrap inkex.unittouu for compatibility.
+    def _parse_tree(self, src, mat):
+        """Parse through an element and its decendants.
+        
+        Return an element (including all decendants), or None if the element
+        cannot be represented.  Uses an explicit stack rather than recursion,
+        and lets lxml filter out incompatible children.
         
         Required arguments:
-        param -- string, to parse
+        src -- Element, group or path element to parse
+        mat -- list, composite transform matrix of the element's parent
         """
-        try:
-            return inkex.unittouu(param)
-        except AttributeError:
-            return self.unittouu(param)
+        root = None
+        stack = [(src, None, mat)]
+        while stack:
+            node, parent, parent_mat = stack.pop()
+            
+            if node.tag == _SVG_G:
+                el = et.Element('group', {_NS['name']: self._get_name(node, 'group')},
+                    nsmap=_NSMAP)
+                
+                # queue child elements (reversed, so they are parsed in order)
+                group_mat = _compose_node_transform(parent_mat, node)
+                for child in node.iterchildren(_SVG_G, _SVG_PATH, reversed=True):
+                    stack.append((child, el, group_mat))
+            else:
+                el = self._parse_path(node, parent_mat)
+                if el is None:
+                    continue
+            
+            if parent is None:
+                root = el
+            else:
+                parent.append(el)
+        
+        return root
     
-    def _get_tag_name(self, node):
-        """Strip namespace from tag."""
-        if '}' in node.tag:
-            return node.tag.split('}', 1)[1]
-        else:
-            return node.tag
+    def _get_name(self, src, el_tag):
+        """Return the id of an element, or a generated unique name.
+        
+        Required arguments:
+        src -- Element, element to name
+        el_tag -- string, android tag (prefix for generated names)
+        """
+        name = src.get('id')
+        if name is None:
+            name = el_tag + str(self.unique_id)
+            self.unique_id += 1
+        return name
     
-    def _parse_child(self, src, ancestors):
-        """Recursively parse through child elements.
+    def _parse_path(self, src, mat):
+        """Parse a path element.
         
-        Return an element (including all decendants).
+        Return an element, or None if the path has no data.
         
         Required arguments:
-        src -- Element, child element to parse
-        ancestors -- list of Element, list of parent elements up to root
+        src -- Element, path element to parse
+        mat -- list, composite transform matrix of the path's parent
         """
-        # check for compatible tag
-        tag = self._get_tag_name(src)
+        # set name attribute
+        attrib = {}
+        attrib[_NS['name']] = self._get_name(src, 'path')
         
-        if tag == 'g':
-            el_tag = 'group'
-        elif tag == 'path':
-            el_tag = 'path'
-        else:
+        # get path data
+        d = src.get('d')
+        if d is None:
             return None
         
-        # initialize android element
-        el = et.Element(el_tag)
+        # apply all transforms (including all ancestors - i.e. "flatten")
+        p = csp.parsePath(d)
         
-        # set name attribute
-        name = src.get('id')
-        if name is None:
-            name = el_tag + str(self.unique_id)
-            self.unique_id += 1
-        el.set(_ns('name'), name)
+        # - ancestor transforms are already composed, so apply them once
+        #   (rounding differs from applying them one by one, so the last
+        #   digits of pathData may not match older exports)
+        # - also remove very small numbers (i.e. scientific notation)
+        mat = _compose_node_transform(mat, src)
+        _transform_points(mat, _csp_points(p), _SMALL_NUMBER)
         
-        if tag == 'g':
-            # parse child elements
-            ancestors.append(src)
-            for child in src:
-                subel = self._parse_child(child, ancestors)
-                if subel is not None:
-                    el.append(subel)
-            ancestors.pop()
-            
+        # save path data in vector element
+        attrib[_NS['pathData']] = _format_path(p)
+        
+        # parse styles
+        if 'style' not in src.attrib:
+            # set some basic defaults
+            attrib[_NS['strokeColor']] = '#000000'
+            attrib[_NS['strokeWidth']] = '1'
+            attrib[_NS['fillColor']] = '#FFFFFF'
         else:
-            # path element
+            style = ss.parseStyle(src.get('style'))
             
-            # get path data
-            d = src.get('d')
-            if d is None:
-                return None
+            # overall object opacity
+            # - not supported in android - merged with other opacities later
+            has_opacity = 'opacity' in style
+            opacity = float(style.get('opacity', 1.0))
             
-            # apply all transforms (including all ancestors - i.e. "flatten")
-            p = csp.parsePath(d)
+            # fill styles
+            fill = style.get('fill')
+            if fill is not None:
+                color = self._get_color(fill)
+                if color is not None:
+                    attrib[_NS['fillColor']] = color
             
-            ancestors.append(src)
-            for anc in reversed(ancestors):
-                if 'transform' in anc.attrib:
-                    transform = anc.get('transform')
-                    t = st.parseTransform(transform)
-                    st.applyTransformToPath(t, p)
-            ancestors.pop()
+            fill_opacity = style.get('fill-opacity')
+            if fill_opacity is not None or has_opacity:
+                alpha = opacity * float(fill_opacity or 1.0)
+                attrib[_NS['fillAlpha']] = str(alpha)
             
-            # remove very small numbers (i.e. scientific notation)
-            for i in range(len(p)):
-                for j in range(len(p[i])):
-                    for k in range(len(p[i][j])):
-                        for l in range(len(p[i][j][k])):
-                            if 'e-' in str(p[i][j][k][l]).lower():
-                                p[i][j][k][l] = 0.0;
+            fill_rule = style.get('fill-rule')
+            if fill_rule == 'evenodd':
+                attrib[_NS['fillType']] = 'evenOdd'
+            elif fill_rule == 'nonzero':
+                attrib[_NS['fillType']] = 'nonZero'
             
-            # save path data in vector element
-            el.set(_ns('pathData'), csp.formatPath(p))
+            # stroke styles
+            stroke = style.get('stroke')
+            if stroke is not None:
+                color = self._get_color(stroke)
+                if color is not None:
+                    attrib[_NS['strokeColor']] = color
             
-            # parse styles
-            if 'style' not in src.attrib:
-                # set some basic defaults
-                el.set(_ns('strokeColor'), '#000000')
-                el.set(_ns('strokeWidth'), '1')
-                el.set(_ns('fillColor'), '#FFFFFF')
-            else:
-                style = ss.parseStyle(src.get('style'))
-                
-                # overall object opacity
-                # - not supported in android - merged with other opacities later
-                opacity = 1.0
-                if 'opacity' in style:
-                    opacity = float(style['opacity'])
-                
-                # fill styles
-                if 'fill' in style:
-                    color = self._get_color(style['fill'])
-                    if color is not None:
-                        el.set(_ns('fillColor'), color)
-                
-                if 'fill-opacity' in style or 'opacity' in style:
-                    alpha = opacity
-                    if 'fill-opacity' in style:
-                        alpha *= float(style['fill-opacity'])
-                    el.set(_ns('fillAlpha'), str(alpha))
-                
-                if 'fill-rule' in style:
-                    if style['fill-rule'] == 'evenodd':
-                        el.set(_ns('fillType'), 'evenOdd')
-                    elif style['fill-rule'] == 'nonzero':
-                        el.set(_ns('fillType'), 'nonZero')
-                
-                # stroke styles
-                if 'stroke' in style:
-                    color = self._get_color(style['stroke'])
-                    if color is not None:
-                        el.set(_ns('strokeColor'), color)
-                
-                if 'stroke-width' in style:
-                    el.set(_ns('strokeWidth'), str(self.__unittouu(style['stroke-width'])))
-                
-                if 'stroke-opacity' in style or 'opacity' in style:
-                    alpha = opacity
-                    if 'stroke-opacity' in style:
-                        alpha *= float(style['stroke-opacity'])
-                    el.set(_ns('strokeAlpha'), str(alpha))
-                
-                if 'stroke-linecap' in style:
-                    el.set(_ns('strokeLineCap'), style['stroke-linecap'])
-                
-                if 'stroke-linejoin' in style:
-                    el.set(_ns('strokeLineJoin'), style['stroke-linejoin'])
-                
-                if 'stroke-miterlimit' in style:
-                    el.set(_ns('strokeMiterLimit'), style['stroke-miterlimit'])
+            stroke_width = style.get('stroke-width')
+            if stroke_width is not None:
+                attrib[_NS['strokeWidth']] = str(self._unittouu(stroke_width))
+            
+            stroke_opacity = style.get('stroke-opacity')
+            if stroke_opacity is not None or has_opacity:
+                alpha = opacity * float(stroke_opacity or 1.0)
+                attrib[_NS['strokeAlpha']] = str(alpha)
+            
+            # - these are passed through unchanged
+            for style_name, attr_name in _STROKE_PASSTHROUGH:
+                value = style.get(style_name)
+                if value is not None:
+                    attrib[attr_name] = value
+        
+        # initialize android element (with all attributes at once)
+        el = et.Element('path', attrib, nsmap=_NSMAP)
         
         return el
     
     def _get_color(self, color):
         """Retrieve and parse an inkscape color for use in android.
         
+        Return a string "#RRGGBB", or None if not understood.  Results are
+        cached, since many paths usually share the same colors.
+        
+        Required arguments:
+        color -- string, inkscape color (from "style" attribute)
+        """
+        if color not in self.color_cache:
+            self.color_cache[color] = self._parse_color(color)
+        return self.color_cache[color]
+    
+    def _parse_color(self, color):
+        """Parse an inkscape color for use in android.
+        
         Return a string "#RRGGBB", or None if not understood.  If inkscape color
         is a gradient, attempt to use one of the gradient colors.
         
@@ -264,31 +384,21 @@ class AndroidVector(inkex.Effect):
             # parse ID to check for a gradient
             id = color[5:-1]
             if id.startswith('linearGradient') or id.startswith('radialGradient'):
-                doc = self.document
-                
                 # find defined gradient
-                prefix_terms = []
-                prefix_terms.append(inkex.addNS('defs', 'svg'))
-                prefix_terms.append('/')
-                prefix_terms.append('*[@id=\'')
-                prefix = ''.join(prefix_terms)
-                suffix = '\']'
-                gradient = doc.find(prefix + id + suffix)
+                gradient = self.defs_index.get(id)
                 
                 # get link to the other gradient definition (with the colors defined)
-                link_attr = inkex.addNS('href', 'xlink')
-                if gradient is None or link_attr not in gradient.attrib:
+                if gradient is None or _XLINK_HREF not in gradient.attrib:
                     return None
-                link_id = gradient.get(link_attr)
+                link_id = gradient.get(_XLINK_HREF)
                 if link_id.startswith('#'):
                     link_id = link_id[1:]
                 
                 # get stop element
-                suffix_terms = []
-                suffix_terms.append('\']/')
-                suffix_terms.append(inkex.addNS('stop', 'svg'))
-                suffix = ''.join(suffix_terms)
-                stop = doc.find(prefix + link_id + suffix)
+                linked = self.defs_index.get(link_id)
+                if linked is None:
+                    return None
+                stop = next(linked.iterchildren(_SVG_STOP), None)
                 
                 # parse style attribute of stop element
                 if stop is None or 'style' not in stop.attrib: